@@ -16,10 +16,15 @@
 Special activation functions.
 """
 
+import math
+
 import torch
 from torch.autograd import Function
 from torch.cuda.amp import custom_bwd, custom_fwd
 
+_TRUNC_EXP_MIN = math.exp(-15)
+_TRUNC_EXP_MAX = math.exp(15)
+
 
 class _TruncExp(Function):  # pylint: disable=abstract-method
     # Implementation from torch-ngp:
@@ -27,14 +32,16 @@ class _TruncExp(Function):  # pylint: disable=abstract-method
     @staticmethod
     @custom_fwd(cast_inputs=torch.float32)
     def forward(ctx, x):  # pylint: disable=arguments-differ
-        ctx.save_for_backward(x)
-        return torch.exp(x)
+        y = torch.exp(x)
+        ctx.save_for_backward(y)
+        return y
 
     @staticmethod
     @custom_bwd
     def backward(ctx, g):  # pylint: disable=arguments-differ
-        x = ctx.saved_tensors[0]
-        return g * torch.exp(x.clamp(-15, 15))
+        y = ctx.saved_tensors[0]
+        # exp is monotonic, so exp(x.clamp(-15, 15)) == exp(x).clamp(exp(-15), exp(15)) and reuses the forward output
+        return g * y.clamp(_TRUNC_EXP_MIN, _TRUNC_EXP_MAX)
 
 
 trunc_exp = _TruncExp.apply
@@ -15,13 +15,15 @@
 """
 Collection of Losses.
 """
+import math
 from enum import Enum
 
 import torch
 from torch import nn
+from torch.autograd import Function
 from torchtyping import TensorType
 from typing_extensions import Literal
-from typing import List
+from typing import List, Optional
 
 from nerfstudio.model_components.op import conv2d_gradfix
 
@@ -58,6 +60,9 @@ def outer(
     https://github.com/kakaobrain/NeRF-Factory/blob/f61bb8744a5cb4820a4d968fb3bfbed777550f4a/src/model/mipnerf360/helper.py#L117
     https://github.com/google-research/multinerf/blob/b02228160d3179300c7d499dca28cb9ca3677f32/internal/stepfun.py#L64
 
+    The edges may be strided views such as ``t[..., :-1]`` and ``t[..., 1:]``. They are stacked into a single
+    search batch, so callers do not need to make them contiguous.
+
     Args:
         t0_starts: start of the interval edges
         t0_ends: end of the interval edges
@@ -65,15 +70,16 @@ def outer(
         t1_ends: end of the interval edges
         y1: weights
     """
-    cy1 = torch.cat([torch.zeros_like(y1[..., :1]), torch.cumsum(y1, dim=-1)], dim=-1)
+    cy1 = torch.nn.functional.pad(torch.cumsum(y1, dim=-1), (1, 0))
 
-    idx_lo = torch.searchsorted(t1_starts.contiguous(), t0_starts.contiguous(), side="right") - 1
-    idx_lo = torch.clamp(idx_lo, min=0, max=y1.shape[-1] - 1)
-    idx_hi = torch.searchsorted(t1_ends.contiguous(), t0_ends.contiguous(), side="right")
-    idx_hi = torch.clamp(idx_hi, min=0, max=y1.shape[-1] - 1)
-    cy1_lo = torch.take_along_dim(cy1[..., :-1], idx_lo, dim=-1)
-    cy1_hi = torch.take_along_dim(cy1[..., 1:], idx_hi, dim=-1)
-    y0_outer = cy1_hi - cy1_lo
+    # Search the start and end edges in one batched call: idx[0] is the bin of each start, idx[1] of each end.
+    idx = torch.searchsorted(torch.stack([t1_starts, t1_ends]), torch.stack([t0_starts, t0_ends]), side="right")
+    idx[0] -= 1
+    idx.clamp_(min=0, max=y1.shape[-1] - 1)
+    # cy1[..., 1:] at idx_hi is cy1 at idx_hi + 1, so both bounds are read from cy1 in a single lookup
+    idx[1] += 1
+    cy1_lo_hi = torch.gather(cy1.expand(2, *cy1.shape), -1, idx)
+    y0_outer = cy1_lo_hi[1] - cy1_lo_hi[0]
 
     return y0_outer
 
@@ -81,8 +87,8 @@ def outer(
 def lossfun_outer(
     t: TensorType[..., "num_samples+1"],
     w: TensorType[..., "num_samples"],
-    t_env: TensorType[..., "num_samples+1"],
-    w_env: TensorType[..., "num_samples"],
+    t_env: TensorType[..., "num_env_samples+1"],
+    w_env: TensorType[..., "num_env_samples"],
 ):
     """
     https://github.com/kakaobrain/NeRF-Factory/blob/f61bb8744a5cb4820a4d968fb3bfbed777550f4a/src/model/mipnerf360/helper.py#L136
@@ -95,7 +101,15 @@ def lossfun_outer(
         w_env: weights that should upper bound the inner (t,w) histogram
     """
     w_outer = outer(t[..., :-1], t[..., 1:], t_env[..., :-1], t_env[..., 1:], w_env)
-    return torch.clip(w - w_outer, min=0) ** 2 / (w + EPS)
+    return _outer_penalty(w, w_outer)
+
+
+@torch.jit.script
+def _outer_penalty(w: torch.Tensor, w_outer: torch.Tensor, eps: float = EPS) -> torch.Tensor:
+    """Penalty on the weights that exceed the enveloping histogram, see lossfun_outer."""
+    # w_outer carries gradients, so clip and square stay out-of-place; the square is not needed by backward
+    excess = torch.clip(w - w_outer, min=0)
+    return (excess * excess).div_(w + eps)
 
 
 def ray_samples_to_sdist(ray_samples):
@@ -114,9 +128,15 @@ def interlevel_loss(weights_list, ray_samples_list):
     """
     c = ray_samples_to_sdist(ray_samples_list[-1]).detach()
     w = weights_list[-1][..., 0].detach()
+    sdists = [ray_samples_to_sdist(ray_samples) for ray_samples in ray_samples_list[:-1]]
+    if len(sdists) > 1 and all(sdist.shape == sdists[0].shape for sdist in sdists):
+        # proposal levels with matching sample counts are evaluated in a single batched call
+        cp = torch.stack(sdists)  # (num_levels, num_rays, num_samples + 1)
+        wp = torch.stack([weights[..., 0] for weights in weights_list[:-1]])  # (num_levels, num_rays, num_samples)
+        loss = lossfun_outer(c.expand(len(sdists), *c.shape), w.expand(len(sdists), *w.shape), cp, wp)
+        return torch.sum(torch.mean(loss, dim=(-2, -1)))
     loss_interlevel = 0.0
-    for ray_samples, weights in zip(ray_samples_list[:-1], weights_list[:-1]):
-        sdist = ray_samples_to_sdist(ray_samples)
+    for sdist, weights in zip(sdists, weights_list[:-1]):
         cp = sdist  # (num_rays, num_samples + 1)
         wp = weights[..., 0]  # (num_rays, num_samples)
         loss_interlevel += torch.mean(lossfun_outer(c, w, cp, wp))
@@ -124,14 +144,19 @@ def interlevel_loss(weights_list, ray_samples_list):
 
 
 # Verified
+@torch.jit.script
 def lossfun_distortion(t, w):
     """
     https://github.com/kakaobrain/NeRF-Factory/blob/f61bb8744a5cb4820a4d968fb3bfbed777550f4a/src/model/mipnerf360/helper.py#L142
     https://github.com/google-research/multinerf/blob/b02228160d3179300c7d499dca28cb9ca3677f32/internal/stepfun.py#L266
     """
     ut = (t[..., 1:] + t[..., :-1]) / 2
-    dut = torch.abs(ut[..., :, None] - ut[..., None, :])
-    loss_inter = torch.sum(w * torch.sum(w[..., None, :] * dut, dim=-1), dim=-1)
+    # ut is sorted along the ray, so sum_ij w_i w_j |u_i - u_j| = 2 sum_i w_i sum_{j<i} w_j (u_i - u_j),
+    # which can be evaluated with exclusive cumsums instead of a (num_samples, num_samples) matrix.
+    wu = w * ut
+    w_lo = torch.cumsum(w, dim=-1) - w
+    wu_lo = torch.cumsum(wu, dim=-1) - wu
+    loss_inter = 2 * torch.sum(w * (ut * w_lo - wu_lo), dim=-1)
 
     loss_intra = torch.sum(w**2 * (t[..., 1:] - t[..., :-1]), dim=-1) / 3
 
@@ -179,10 +204,13 @@ def nerfstudio_distortion_loss(
     assert starts is not None and ends is not None, "Ray samples must have spacing starts and ends"
     midpoints = (starts + ends) / 2.0  # (..., num_samples, 1)
 
-    loss = (
-        weights * weights[..., None, :, 0] * torch.abs(midpoints - midpoints[..., None, :, 0])
-    )  # (..., num_samples, num_samples)
-    loss = torch.sum(loss, dim=(-1, -2))[..., None]  # (..., num_samples)
+    # Midpoints are sorted along the ray, so the pairwise |m_i - m_j| term reduces to exclusive cumsums.
+    m = midpoints[..., 0]  # (..., num_samples)
+    w = weights[..., 0]  # (..., num_samples)
+    wm = w * m
+    w_lo = torch.cumsum(w, dim=-1) - w
+    wm_lo = torch.cumsum(wm, dim=-1) - wm
+    loss = 2 * torch.sum(w * (m * w_lo - wm_lo), dim=-1)[..., None]  # (..., 1)
     loss = loss + 1 / 3.0 * torch.sum(weights**2 * (ends - starts), dim=-2)
 
     return loss
@@ -199,8 +227,8 @@ def orientation_loss(
     w = weights
     n = normals
     v = viewdirs * -1
-    n_dot_v = (n * v[..., None, :]).sum(axis=-1)
-    return (w[..., 0] * torch.fmin(torch.zeros_like(n_dot_v), n_dot_v) ** 2).sum(dim=-1)
+    n_dot_v = torch.einsum("...sc,...c->...s", n, v)
+    return (w[..., 0] * torch.fmin(n_dot_v.new_zeros(()), n_dot_v) ** 2).sum(dim=-1)
 
 
 def pred_normal_loss(
@@ -209,7 +237,29 @@ def pred_normal_loss(
     pred_normals: TensorType["bs":..., "num_samples", 3],
 ):
     """Loss between normals calculated from density and normals from prediction network."""
-    return (weights[..., 0] * (1.0 - torch.sum(normals * pred_normals, dim=-1))).sum(dim=-1)
+    n_dot_pred = torch.einsum("...sc,...sc->...s", normals, pred_normals)
+    return (weights[..., 0] * (1.0 - n_dot_pred)).sum(dim=-1)
+
+
+class _DSNeRFDepthLoss(Function):  # pylint: disable=abstract-method
+    """Per-ray DS-NeRF depth loss with an explicit backward w.r.t. the weights.
+
+    Sample positions, lengths and ground truth depths are treated as constants, so only the gaussian depth
+    term and the weights need to be kept around for the backward pass.
+    """
+
+    @staticmethod
+    def forward(ctx, weights, termination_depth, steps, lengths, sigma):  # pylint: disable=arguments-differ
+        assert not any(ctx.needs_input_grad[1:]), "Only the weights of the DS-NeRF depth loss can require grad"
+        gaussian = torch.exp(-((steps - termination_depth[:, None]) ** 2) / (2 * sigma)) * lengths
+        ctx.save_for_backward(weights, gaussian)
+        return torch.sum(-torch.log(weights + EPS) * gaussian, dim=-2)
+
+    @staticmethod
+    def backward(ctx, g):  # pylint: disable=arguments-differ
+        weights, gaussian = ctx.saved_tensors
+        grad_weights = -g[..., None, :] * gaussian / (weights + EPS)
+        return grad_weights, None, None, None, None
 
 
 def ds_nerf_depth_loss(
@@ -217,8 +267,8 @@ def ds_nerf_depth_loss(
     termination_depth: TensorType[..., 1],
     steps: TensorType[..., "num_samples", 1],
     lengths: TensorType[..., "num_samples", 1],
-    sigma: TensorType[0],
-) -> TensorType[..., 1]:
+    sigma: TensorType[1],
+) -> TensorType[()]:
     """Depth loss from Depth-supervised NeRF (Deng et al., 2022).
 
     Args:
@@ -232,9 +282,10 @@ def ds_nerf_depth_loss(
     """
     depth_mask = termination_depth > 0
 
-    loss = -torch.log(weights + EPS) * torch.exp(-((steps - termination_depth[:, None]) ** 2) / (2 * sigma)) * lengths
-    loss = loss.sum(-2) * depth_mask
-    return torch.mean(loss)
+    # rays without ground truth depth add zero, so the per-sample loss is only evaluated on valid rays
+    valid = depth_mask[..., 0]
+    loss = _DSNeRFDepthLoss.apply(weights[valid], termination_depth[valid], steps[valid], lengths[valid], sigma)
+    return torch.sum(loss) / depth_mask.numel()
 
 
 def urban_radiance_field_depth_loss(
@@ -242,8 +293,8 @@ def urban_radiance_field_depth_loss(
     termination_depth: TensorType[..., 1],
     predicted_depth: TensorType[..., 1],
     steps: TensorType[..., "num_samples", 1],
-    sigma: TensorType[0],
-) -> TensorType[..., 1]:
+    sigma: TensorType[1],
+) -> TensorType[()]:
     """Lidar losses from Urban Radiance Fields (Rematas et al., 2022).
 
     Args:
@@ -257,23 +308,38 @@ def urban_radiance_field_depth_loss(
     """
     depth_mask = termination_depth > 0
 
+    # gather the rays with lidar depth before building the line of sight masks and target densities
+    num_rays = depth_mask.numel()
+    valid = depth_mask[..., 0]
+    weights, termination_depth, predicted_depth, steps = (
+        weights[valid],
+        termination_depth[valid],
+        predicted_depth[valid],
+        steps[valid],
+    )
+
     # Expected depth loss
     expected_depth_loss = (termination_depth - predicted_depth) ** 2
 
     # Line of sight losses
-    target_distribution = torch.distributions.normal.Normal(0.0, sigma / URF_SIGMA_SCALE_FACTOR)
+    target_sigma = sigma / URF_SIGMA_SCALE_FACTOR
     termination_depth = termination_depth[:, None]
     line_of_sight_loss_near_mask = torch.logical_and(
         steps <= termination_depth + sigma, steps >= termination_depth - sigma
     )
-    line_of_sight_loss_near = (weights - torch.exp(target_distribution.log_prob(steps - termination_depth))) ** 2
-    line_of_sight_loss_near = (line_of_sight_loss_near_mask * line_of_sight_loss_near).sum(-2)
+    # Normal(0, target_sigma) density, evaluated directly instead of through torch.distributions
+    target_density = torch.exp(-0.5 * ((steps - termination_depth) / target_sigma) ** 2) / (
+        target_sigma * math.sqrt(2 * math.pi)
+    )
+    line_of_sight_loss_near = (weights - target_density) ** 2
     line_of_sight_loss_empty_mask = steps < termination_depth - sigma
-    line_of_sight_loss_empty = (line_of_sight_loss_empty_mask * weights**2).sum(-2)
-    line_of_sight_loss = line_of_sight_loss_near + line_of_sight_loss_empty
+    # the near and empty regions are disjoint, so both terms are reduced in a single sum
+    line_of_sight_loss = (
+        line_of_sight_loss_near_mask * line_of_sight_loss_near + line_of_sight_loss_empty_mask * weights**2
+    ).sum(-2)
 
-    loss = (expected_depth_loss + line_of_sight_loss) * depth_mask
-    return torch.mean(loss)
+    loss = expected_depth_loss + line_of_sight_loss
+    return torch.sum(loss) / num_rays
 
 
 def depth_loss(
@@ -281,11 +347,11 @@ def depth_loss(
     ray_samples: RaySamples,
     termination_depth: TensorType[..., 1],
     predicted_depth: TensorType[..., 1],
-    sigma: TensorType[0],
+    sigma: TensorType[1],
     directions_norm: TensorType[..., 1],
     is_euclidean: bool,
     depth_loss_type: DepthLossType,
-) -> TensorType[0]:
+) -> TensorType[()]:
     """Implementation of depth losses.
 
     Args:
@@ -317,7 +383,7 @@ def depth_loss(
 
 def monosdf_normal_loss(
     normal_pred: TensorType["num_samples", 3], normal_gt: TensorType["num_samples", 3]
-) -> TensorType[0]:
+) -> TensorType[()]:
     """
     Normal consistency loss proposed in monosdf - https://niujinshuchong.github.io/monosdf/
     Enforces consistency between the volume rendered normal and the predicted monocular normal.
@@ -326,8 +392,14 @@ def monosdf_normal_loss(
         normal_pred: volume rendered normal
         normal_gt: monocular normal
     """
-    normal_gt = torch.nn.functional.normalize(normal_gt, p=2, dim=-1)
-    normal_pred = torch.nn.functional.normalize(normal_pred, p=2, dim=-1)
+    return _normal_consistency(normal_pred, normal_gt)
+
+
+@torch.jit.script
+def _normal_consistency(normal_pred: torch.Tensor, normal_gt: torch.Tensor) -> torch.Tensor:
+    """L1 and angular consistency between normalized normals, see monosdf_normal_loss."""
+    normal_gt = torch.nn.functional.normalize(normal_gt, p=2.0, dim=-1)
+    normal_pred = torch.nn.functional.normalize(normal_pred, p=2.0, dim=-1)
     l1 = torch.abs(normal_pred - normal_gt).sum(dim=-1).mean()
     cos = (1.0 - torch.sum(normal_pred * normal_gt, dim=-1)).mean()
     return l1 + cos
@@ -342,12 +414,10 @@ class MiDaSMSELoss(nn.Module):
         super().__init__()
 
         self.reduction_type: Literal["image", "batch"] = reduction_type
-        # reduction here is different from the image/batch-based reduction. This is either "mean" or "sum"
-        self.mse_loss = MSELoss(reduction="none")
 
     def forward(
         self, prediction: TensorType[1, 32, "mult"], target: TensorType[1, 32, "mult"], mask: TensorType[1, 32, "mult"]
-    ) -> TensorType[0]:
+    ) -> TensorType[()]:
         """
         Args:
             prediction: predicted depth map
@@ -357,7 +427,10 @@ class MiDaSMSELoss(nn.Module):
             mse loss based on reduction function
         """
         summed_mask = torch.sum(mask, (1, 2))
-        image_loss = torch.sum(self.mse_loss(prediction, target) * mask, (1, 2))
+        # squared error stays in the input precision (autocast would upcast mse_loss),
+        # only half precision sums are promoted to fp32
+        sum_dtype = torch.promote_types(prediction.dtype, torch.float32)
+        image_loss = torch.sum(((prediction - target) ** 2).mul_(mask), (1, 2), dtype=sum_dtype)
         # multiply by 2 magic number?
         image_loss = masked_reduction(image_loss, 2 * summed_mask, self.reduction_type)
 
@@ -384,7 +457,7 @@ class GradientLoss(nn.Module):
 
     def forward(
         self, prediction: TensorType[1, 32, "mult"], target: TensorType[1, 32, "mult"], mask: TensorType[1, 32, "mult"]
-    ) -> TensorType[0]:
+    ) -> TensorType[()]:
         """
         Args:
             prediction: predicted depth map
@@ -395,21 +468,28 @@ class GradientLoss(nn.Module):
         """
         total = 0
 
+        # masking commutes with striding, so the masked residual is computed once at full resolution
+        # and every scale is downsampled from the same buffer
+        diff = (prediction - target).mul_(mask)
+
         for scale in range(self.__scales):
             step = pow(2, scale)
 
-            grad_loss = self.gradient_loss(
-                prediction[:, ::step, ::step],
-                target[:, ::step, ::step],
-                mask[:, ::step, ::step],
+            # copy each downsampled scale into a contiguous tile once, so the finite differences read dense memory
+            grad_loss = self.masked_gradient_loss(
+                diff[:, ::step, ::step].contiguous(),
+                mask[:, ::step, ::step].contiguous(),
             )
             total += grad_loss
 
         return total
 
     def gradient_loss(
-        self, prediction: TensorType[1, 32, "mult"], target: TensorType[1, 32, "mult"], mask: TensorType[1, 32, "mult"]
-    ) -> TensorType[0]:
+        self,
+        prediction: TensorType[1, "height", "width"],
+        target: TensorType[1, "height", "width"],
+        mask: TensorType[1, "height", "width"],
+    ) -> TensorType[()]:
         """
         multiscale, scale-invariant gradient matching term to the disparity space.
         This term biases discontinuities to be sharp and to coincide with discontinuities in the ground truth
@@ -421,19 +501,32 @@ class GradientLoss(nn.Module):
         Returns:
             gradient loss based on reduction function
         """
+        diff = (prediction - target).mul_(mask)
+        return self.masked_gradient_loss(diff, mask)
+
+    def masked_gradient_loss(
+        self, diff: TensorType[1, "height", "width"], mask: TensorType[1, "height", "width"]
+    ) -> TensorType[()]:
+        """
+        Gradient matching term on an already masked residual, see gradient_loss.
+        Args:
+            diff: masked difference between predicted and ground truth depth maps
+            mask: mask of valid pixels
+        Returns:
+            gradient loss based on reduction function
+        """
         summed_mask = torch.sum(mask, (1, 2))
-        diff = prediction - target
-        diff = torch.mul(mask, diff)
 
         grad_x = torch.abs(diff[:, :, 1:] - diff[:, :, :-1])
         mask_x = torch.mul(mask[:, :, 1:], mask[:, :, :-1])
-        grad_x = torch.mul(mask_x, grad_x)
+        grad_x.mul_(mask_x)
 
         grad_y = torch.abs(diff[:, 1:, :] - diff[:, :-1, :])
         mask_y = torch.mul(mask[:, 1:, :], mask[:, :-1, :])
-        grad_y = torch.mul(mask_y, grad_y)
+        grad_y.mul_(mask_y)
 
-        image_loss = torch.sum(grad_x, (1, 2)) + torch.sum(grad_y, (1, 2))
+        sum_dtype = torch.promote_types(diff.dtype, torch.float32)
+        image_loss = torch.sum(grad_x, (1, 2), dtype=sum_dtype) + torch.sum(grad_y, (1, 2), dtype=sum_dtype)
         image_loss = masked_reduction(image_loss, summed_mask, self.reduction_type)
 
         return image_loss
@@ -462,7 +555,7 @@ class ScaleAndShiftInvariantLoss(nn.Module):
 
     def forward(
         self, prediction: TensorType[1, 32, "mult"], target: TensorType[1, 32, "mult"], mask: TensorType[1, 32, "mult"]
-    ) -> TensorType[0]:
+    ) -> TensorType[()]:
         """
         Args:
             prediction: predicted depth map (unnormalized)
@@ -472,7 +565,7 @@ class ScaleAndShiftInvariantLoss(nn.Module):
             scale and shift invariant loss
         """
         scale, shift = normalized_depth_scale_and_shift(prediction, target, mask)
-        self.__prediction_ssi = scale.view(-1, 1, 1) * prediction + shift.view(-1, 1, 1)
+        self.__prediction_ssi = torch.addcmul(shift.view(-1, 1, 1), scale.view(-1, 1, 1), prediction)
 
         total = self.__data_loss(self.__prediction_ssi, target, mask)
         if self.__alpha > 0:
@@ -504,28 +597,33 @@ class GANLoss(nn.Module):
         super().__init__()
         self.m_type = m_type
 
-        self.non_saturating_loss = torch.nn.functional.softplus
+        # softplus(-x) == bce(x, 1) and softplus(x) == bce(x, 0), computed by the fused BCE-with-logits kernel
+        self.non_saturating_loss = torch.nn.functional.binary_cross_entropy_with_logits
         self.r1_gamma = r1_gamma #NOTE - Config로부터 가져올 것. 
         self.reg_step = reg_step
 
 
     def forward(
-        self, preds: List[TensorType['batch', 1]], **kwargs
+        self, preds: List[TensorType['batch', 1]], step: int, real_img: Optional[torch.Tensor] = None, **kwargs
         # real_pred: TensorType['batch', 1], fake_pred: TensorType['batch', 1], **kwargs # real_img = []
         # self, prediction: TensorType[1, 32, "mult"], target: TensorType[1, 32, "mult"], mask: TensorType[1, 32, "mult"] # 여기도 바뀌어야하는게 입력이 real / fake임.
-    ) -> TensorType[0]:
+    ) -> TensorType[()]:
 
 
         if self.m_type == 'G':
             fake_pred = preds[0]
-            loss_Gmain = self.non_saturating_loss(-fake_pred).mean()
+            loss_Gmain = self.non_saturating_loss(fake_pred, torch.ones_like(fake_pred))
             loss = loss_Gmain
 
         elif self.m_type == 'D':
             fake_pred, real_pred = preds
-            loss_Dmain = self.non_saturating_loss(-real_pred).mean() + self.non_saturating_loss(fake_pred).mean()
+            loss_Dmain = self.non_saturating_loss(real_pred, torch.ones_like(real_pred)) + self.non_saturating_loss(
+                fake_pred, torch.zeros_like(fake_pred)
+            )
             loss = loss_Dmain
             if step % self.reg_step == 0:
+                if real_img is None:
+                    raise ValueError("R1 regularization needs the real images the discriminator was evaluated on")
                 loss_r1 = self.r1_regularization(real_pred,real_img) * (self.r1_gamma/2) # *args같은거 쓰면 될 듯.
                 loss += loss_r1
         return loss
@@ -533,8 +631,9 @@ class GANLoss(nn.Module):
 
     def r1_regularization(self, real_pred, real_img):
         with conv2d_gradfix.no_weight_gradients():
-            grad_real = torch.autograd.grad(outputs = real_pred.sum(), inputs=real_img, create_graph=True)
-            grad_penalty = grad_real.pow(2).reshape(grad_real.shape[0], -1).sum(1).mean()
+            # create_graph is required: the penalty is backpropagated into the discriminator weights
+            (grad_real,) = torch.autograd.grad(outputs = real_pred.sum(), inputs=real_img, create_graph=True)
+        grad_penalty = grad_real.square().flatten(1).sum(1).mean()
         return grad_penalty
          
 
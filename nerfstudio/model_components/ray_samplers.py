@@ -308,8 +308,8 @@ class PDFSampler(Sampler):
         weights_sum += padding
 
         pdf = weights / weights_sum
-        cdf = torch.min(torch.ones_like(pdf), torch.cumsum(pdf, dim=-1))
-        cdf = torch.cat([torch.zeros_like(cdf[..., :1]), cdf], dim=-1)
+        cdf = torch.clamp(torch.cumsum(pdf, dim=-1), max=1.0)
+        cdf = torch.nn.functional.pad(cdf, (1, 0))
 
         if self.train_stratified and self.training:
             # Stratified samples between 0 and 1
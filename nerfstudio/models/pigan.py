@@ -256,7 +256,8 @@ class PiganModel(Model):
     def get_discriminator(self, model_outputs, batch=None):
         fake_pred = self.discriminator(model_outputs)
         if batch is not None:
-            real_pred = self.discriminator(batch['image'])
+            # R1 regularization differentiates the real predictions w.r.t. the real images
+            real_pred = self.discriminator(batch['image'].requires_grad_())
             return fake_pred, real_pred
         else:
             return fake_pred
@@ -271,7 +272,7 @@ class PiganModel(Model):
             g_loss = self.generator_loss(preds, step)
             loss_dict = {"generator_loss": g_loss}
         elif len(preds)==2:
-            d_loss = self.discriminator_loss(preds, step)
+            d_loss = self.discriminator_loss(preds, step, real_img=batch["image"])
             loss_dict = {"discriminator_loss": d_loss}
         return loss_dict
     
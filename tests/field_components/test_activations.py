@@ -0,0 +1,24 @@
+"""
+Activations Test
+"""
+import torch
+
+from nerfstudio.field_components.activations import trunc_exp
+
+
+def test_trunc_exp():
+    """Test trunc_exp forward and clipped backward pass"""
+    inf = float("inf")
+    x = torch.tensor([-inf, -100.0, -15.0, -1.0, 0.0, 1.0, 15.0, 20.0, 100.0, inf], requires_grad=True)
+    g = torch.rand_like(x)
+
+    y = trunc_exp(x)
+    assert torch.equal(y, torch.exp(x.detach()))
+
+    (grad,) = torch.autograd.grad(y, x, g)
+    expected = g * torch.exp(x.detach().clamp(-15, 15))
+    assert torch.allclose(grad, expected)
+
+    x_nan = torch.tensor([float("nan")], requires_grad=True)
+    (grad_nan,) = torch.autograd.grad(trunc_exp(x_nan), x_nan, torch.ones_like(x_nan))
+    assert torch.isnan(grad_nan).all()
@@ -0,0 +1,294 @@
+"""
+Test losses
+"""
+import pytest
+import torch
+
+from nerfstudio.cameras.rays import Frustums, RaySamples
+from nerfstudio.model_components import losses
+
+
+def test_lossfun_distortion():
+    """Test closed form distortion loss against the pairwise formulation"""
+    num_rays, num_samples = 8, 32
+
+    t = torch.sort(torch.rand((num_rays, num_samples + 1)), dim=-1)[0]
+    w = torch.rand((num_rays, num_samples))
+    w /= torch.sum(w, dim=-1, keepdim=True)
+
+    ut = (t[..., 1:] + t[..., :-1]) / 2
+    dut = torch.abs(ut[..., :, None] - ut[..., None, :])
+    loss_inter = torch.sum(w * torch.sum(w[..., None, :] * dut, dim=-1), dim=-1)
+    loss_intra = torch.sum(w**2 * (t[..., 1:] - t[..., :-1]), dim=-1) / 3
+
+    loss = losses.lossfun_distortion(t, w)
+    assert loss.shape == (num_rays,)
+    assert torch.allclose(loss, loss_inter + loss_intra, atol=1e-6)
+
+
+def test_nerfstudio_distortion_loss():
+    """Test closed form ray distortion loss against the pairwise formulation"""
+    num_rays, num_samples = 8, 32
+
+    bins = torch.sort(torch.rand((num_rays, num_samples + 1, 1)), dim=-2)[0]
+    starts, ends = bins[..., :-1, :], bins[..., 1:, :]
+    frustums = Frustums(
+        origins=torch.zeros((num_rays, num_samples, 3)),
+        directions=torch.ones((num_rays, num_samples, 3)),
+        starts=starts,
+        ends=ends,
+        pixel_area=torch.ones((num_rays, num_samples, 1)),
+    )
+    ray_samples = RaySamples(
+        frustums=frustums,
+        spacing_starts=starts,
+        spacing_ends=ends,
+    )
+    weights = torch.rand((num_rays, num_samples, 1))
+    weights /= torch.sum(weights, dim=-2, keepdim=True)
+
+    midpoints = (starts + ends) / 2.0
+    expected = weights * weights[..., None, :, 0] * torch.abs(midpoints - midpoints[..., None, :, 0])
+    expected = torch.sum(expected, dim=(-1, -2))[..., None]
+    expected = expected + 1 / 3.0 * torch.sum(weights**2 * (ends - starts), dim=-2)
+
+    loss = losses.nerfstudio_distortion_loss(ray_samples, weights=weights)
+    assert loss.shape == (num_rays, 1)
+    assert torch.allclose(loss, expected, atol=1e-6)
+
+
+def test_ds_nerf_depth_loss():
+    """Test DS-NeRF depth loss value and weight gradients against autograd"""
+    num_rays, num_samples = 8, 32
+
+    steps = torch.sort(torch.rand((num_rays, num_samples, 1)), dim=-2)[0]
+    lengths = torch.full((num_rays, num_samples, 1), 1.0 / num_samples)
+    termination_depth = torch.rand((num_rays, 1))
+    termination_depth[0] = 0
+    sigma = torch.tensor([0.01])
+    weights = torch.rand((num_rays, num_samples, 1), requires_grad=True)
+
+    loss = losses.ds_nerf_depth_loss(weights, termination_depth, steps, lengths, sigma)
+    (grad,) = torch.autograd.grad(loss, weights)
+
+    expected = -torch.log(weights + losses.EPS) * torch.exp(-((steps - termination_depth[:, None]) ** 2) / (2 * sigma))
+    expected = torch.mean(torch.sum(expected * lengths, dim=-2) * (termination_depth > 0))
+    (expected_grad,) = torch.autograd.grad(expected, weights)
+
+    assert torch.allclose(loss, expected)
+    assert torch.allclose(grad, expected_grad)
+
+
+def test_outer():
+    """Test outer measure against a per-bin reference"""
+    num_rays, num_samples_0, num_samples_1 = 4, 8, 16
+
+    t0 = torch.sort(torch.rand((num_rays, num_samples_0 + 1)), dim=-1)[0]
+    t1 = torch.sort(torch.rand((num_rays, num_samples_1 + 1)), dim=-1)[0]
+    y1 = torch.rand((num_rays, num_samples_1))
+
+    cy1 = torch.cat([torch.zeros_like(y1[..., :1]), torch.cumsum(y1, dim=-1)], dim=-1)
+    idx_lo = torch.searchsorted(t1[..., :-1].contiguous(), t0[..., :-1].contiguous(), side="right") - 1
+    idx_lo = torch.clamp(idx_lo, min=0, max=num_samples_1 - 1)
+    idx_hi = torch.searchsorted(t1[..., 1:].contiguous(), t0[..., 1:].contiguous(), side="right")
+    idx_hi = torch.clamp(idx_hi, min=0, max=num_samples_1 - 1)
+    expected = torch.gather(cy1[..., 1:], -1, idx_hi) - torch.gather(cy1[..., :-1], -1, idx_lo)
+
+    y0 = losses.outer(t0[..., :-1], t0[..., 1:], t1[..., :-1], t1[..., 1:], y1)
+    assert y0.shape == (num_rays, num_samples_0)
+    assert torch.allclose(y0, expected)
+
+
+def test_urban_radiance_field_depth_loss():
+    """Test URF depth loss against the torch.distributions formulation"""
+    num_rays, num_samples = 8, 32
+
+    steps = torch.sort(torch.rand((num_rays, num_samples, 1)), dim=-2)[0]
+    termination_depth = torch.rand((num_rays, 1))
+    termination_depth[0] = 0
+    predicted_depth = torch.rand((num_rays, 1))
+    sigma = torch.tensor([0.1])
+    weights = torch.rand((num_rays, num_samples, 1))
+
+    target_distribution = torch.distributions.normal.Normal(0.0, sigma / losses.URF_SIGMA_SCALE_FACTOR)
+    depth = termination_depth[:, None]
+    near_mask = torch.logical_and(steps <= depth + sigma, steps >= depth - sigma)
+    near = (near_mask * (weights - torch.exp(target_distribution.log_prob(steps - depth))) ** 2).sum(-2)
+    empty = ((steps < depth - sigma) * weights**2).sum(-2)
+    expected = (termination_depth - predicted_depth) ** 2 + near + empty
+    expected = torch.mean(expected * (termination_depth > 0))
+
+    loss = losses.urban_radiance_field_depth_loss(weights, termination_depth, predicted_depth, steps, sigma)
+    assert torch.allclose(loss, expected)
+
+
+def test_normal_losses():
+    """Test orientation and predicted normal losses against broadcast formulations"""
+    num_rays, num_samples = 8, 32
+
+    weights = torch.rand((num_rays, num_samples, 1))
+    normals = torch.nn.functional.normalize(torch.randn((num_rays, num_samples, 3)), dim=-1)
+    pred_normals = torch.nn.functional.normalize(torch.randn((num_rays, num_samples, 3)), dim=-1)
+    viewdirs = torch.nn.functional.normalize(torch.randn((num_rays, 3)), dim=-1)
+
+    n_dot_v = (normals * -viewdirs[..., None, :]).sum(dim=-1)
+    expected = (weights[..., 0] * torch.fmin(torch.zeros_like(n_dot_v), n_dot_v) ** 2).sum(dim=-1)
+    assert torch.allclose(losses.orientation_loss(weights, normals, viewdirs), expected, atol=1e-6)
+
+    expected = (weights[..., 0] * (1.0 - torch.sum(normals * pred_normals, dim=-1))).sum(dim=-1)
+    assert torch.allclose(losses.pred_normal_loss(weights, normals, pred_normals), expected, atol=1e-6)
+
+
+def test_gan_loss():
+    """Test non-saturating generator loss against the softplus formulation"""
+    fake_pred = torch.randn((8, 1))
+
+    g_loss = losses.GANLoss(m_type="G")([fake_pred], 0)
+    expected = torch.nn.functional.softplus(-fake_pred).mean()
+    assert torch.allclose(g_loss, expected)
+
+
+def test_interlevel_loss():
+    """Test batched interlevel loss against the per-level formulation"""
+    num_rays, num_samples, num_proposal_samples = 8, 16, 32
+
+    def make_ray_samples(n):
+        bins = torch.sort(torch.rand((num_rays, n + 1, 1)), dim=-2)[0]
+        bins[:, 0], bins[:, -1] = 0.0, 1.0
+        frustums = Frustums(
+            origins=torch.zeros((num_rays, n, 3)),
+            directions=torch.ones((num_rays, n, 3)),
+            starts=bins[:, :-1],
+            ends=bins[:, 1:],
+            pixel_area=torch.ones((num_rays, n, 1)),
+        )
+        return RaySamples(frustums=frustums, spacing_starts=bins[:, :-1], spacing_ends=bins[:, 1:])
+
+    for proposal_samples in ([num_proposal_samples, num_proposal_samples], [num_proposal_samples, num_samples]):
+        ray_samples_list = [make_ray_samples(n) for n in proposal_samples + [num_samples]]
+        weights_list = [torch.rand((num_rays, rs.shape[-1], 1)) for rs in ray_samples_list]
+
+        c = losses.ray_samples_to_sdist(ray_samples_list[-1])
+        w = weights_list[-1][..., 0]
+        expected = sum(
+            torch.mean(losses.lossfun_outer(c, w, losses.ray_samples_to_sdist(rs), ws[..., 0]))
+            for rs, ws in zip(ray_samples_list[:-1], weights_list[:-1])
+        )
+
+        loss = losses.interlevel_loss(weights_list, ray_samples_list)
+        assert torch.allclose(loss, expected)
+
+
+def test_gradient_loss():
+    """Test multiscale gradient loss against per-scale strided views"""
+    prediction = torch.rand((1, 32, 24))
+    target = torch.rand((1, 32, 24))
+    mask = torch.rand((1, 32, 24)) > 0.2
+
+    gradient_loss = losses.GradientLoss(scales=4)
+    expected = sum(
+        gradient_loss.gradient_loss(prediction[:, ::step, ::step], target[:, ::step, ::step], mask[:, ::step, ::step])
+        for step in (1, 2, 4, 8)
+    )
+    assert torch.allclose(gradient_loss(prediction, target, mask), expected)
+
+
+def test_midas_losses_precision():
+    """Test that MiDaS style depth losses promote half precision sums and keep double precision"""
+    prediction = torch.rand((1, 32, 24))
+    target = torch.rand((1, 32, 24))
+    mask = torch.rand((1, 32, 24)) > 0.2
+
+    for loss_fn in (losses.MiDaSMSELoss(), losses.GradientLoss(scales=1)):
+        loss_bf16 = loss_fn(prediction.bfloat16(), target.bfloat16(), mask)
+        expected = loss_fn(prediction.bfloat16().float(), target.bfloat16().float(), mask)
+        assert loss_bf16.dtype == torch.float32
+        assert torch.allclose(loss_bf16, expected, rtol=1e-2)
+
+    for loss_fn in (losses.MiDaSMSELoss(), losses.GradientLoss(scales=1), losses.ScaleAndShiftInvariantLoss(scales=1)):
+        loss_fp64 = loss_fn(prediction.double(), target.double(), mask)
+        assert loss_fp64.dtype == torch.float64
+        assert torch.allclose(loss_fp64.float(), loss_fn(prediction, target, mask), rtol=1e-4)
+
+
+def test_r1_regularization():
+    """Test that the R1 penalty matches the gradient norm and backpropagates into the discriminator"""
+    discriminator = torch.nn.Conv2d(3, 1, kernel_size=3)
+    real_img = torch.randn((2, 3, 8, 8), requires_grad=True)
+    real_pred = torch.tanh(discriminator(real_img)).mean(dim=(2, 3))
+
+    d_loss = losses.GANLoss(m_type="D")
+    penalty = d_loss.r1_regularization(real_pred, real_img)
+
+    (grad_real,) = torch.autograd.grad(real_pred.sum(), real_img, create_graph=True)
+    expected = grad_real.pow(2).reshape(grad_real.shape[0], -1).sum(1).mean()
+    assert torch.allclose(penalty, expected)
+
+    penalty.backward()
+    assert discriminator.weight.grad is not None
+    assert torch.any(discriminator.weight.grad != 0)
+
+
+def test_discriminator_loss():
+    """Test non-saturating discriminator loss with and without the R1 penalty"""
+    discriminator = torch.nn.Conv2d(3, 1, kernel_size=3)
+    real_img = torch.randn((2, 3, 8, 8), requires_grad=True)
+    real_pred = torch.tanh(discriminator(real_img)).mean(dim=(2, 3))
+    fake_pred = torch.randn((2, 1))
+
+    d_loss = losses.GANLoss(m_type="D", r1_gamma=0.2, reg_step=16)
+    expected = torch.nn.functional.softplus(-real_pred).mean() + torch.nn.functional.softplus(fake_pred).mean()
+    assert torch.allclose(d_loss([fake_pred, real_pred], 1, real_img=real_img), expected)
+    assert torch.allclose(d_loss([fake_pred, real_pred], 1), expected)
+    with pytest.raises(ValueError):
+        d_loss([fake_pred, real_pred], 0)
+
+    r1 = d_loss.r1_regularization(real_pred, real_img) * 0.1
+    assert torch.allclose(d_loss([fake_pred, real_pred], 0, real_img=real_img), expected + r1)
+
+
+def test_lossfun_outer():
+    """Test scripted proposal penalty against the eager formulation"""
+    num_rays, num_samples, num_env_samples = 8, 16, 32
+
+    t = torch.sort(torch.rand((num_rays, num_samples + 1)), dim=-1)[0]
+    w = torch.rand((num_rays, num_samples))
+    t_env = torch.sort(torch.rand((num_rays, num_env_samples + 1)), dim=-1)[0]
+    w_env = torch.rand((num_rays, num_env_samples), requires_grad=True)
+
+    w_outer = losses.outer(t[..., :-1], t[..., 1:], t_env[..., :-1], t_env[..., 1:], w_env)
+    expected = torch.clip(w - w_outer, min=0) ** 2 / (w + losses.EPS)
+    (expected_grad,) = torch.autograd.grad(expected.sum(), w_env)
+
+    loss = losses.lossfun_outer(t, w, t_env, w_env)
+    (grad,) = torch.autograd.grad(loss.sum(), w_env)
+    assert torch.allclose(loss, expected)
+    assert torch.allclose(grad, expected_grad)
+
+
+def test_monosdf_normal_loss():
+    """Test scripted monosdf normal loss against the eager formulation"""
+    normal_pred = torch.randn((64, 3))
+    normal_gt = torch.randn((64, 3))
+
+    pred = torch.nn.functional.normalize(normal_pred, p=2, dim=-1)
+    gt = torch.nn.functional.normalize(normal_gt, p=2, dim=-1)
+    expected = torch.abs(pred - gt).sum(dim=-1).mean() + (1.0 - torch.sum(pred * gt, dim=-1)).mean()
+
+    loss = losses.monosdf_normal_loss(normal_pred, normal_gt)
+    assert loss.shape == ()
+    assert torch.allclose(loss, expected)
+
+
+def test_ds_nerf_depth_loss_constant_inputs():
+    """Test that DS-NeRF depth loss rejects sample positions that require grad"""
+    num_rays, num_samples = 4, 8
+
+    weights = torch.rand((num_rays, num_samples, 1), requires_grad=True)
+    termination_depth = torch.rand((num_rays, 1))
+    steps = torch.rand((num_rays, num_samples, 1), requires_grad=True)
+    lengths = torch.full((num_rays, num_samples, 1), 1.0 / num_samples)
+    sigma = torch.tensor([0.01])
+
+    with pytest.raises(AssertionError):
+        losses.ds_nerf_depth_loss(weights, termination_depth, steps, lengths, sigma)